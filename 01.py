@@ -6,14 +6,13 @@ a Parquet file.
 """
 
 # stdlib imports
-import re
-from io import BytesIO
+from io import RawIOBase
 from pathlib import Path
 
 # third-party imports
 import pyarrow as pa
-from pyarrow.csv import ConvertOptions, ParseOptions, ReadOptions, read_csv
-from pyarrow.parquet import write_table
+from pyarrow.csv import ConvertOptions, ParseOptions, ReadOptions, open_csv
+from pyarrow.parquet import ParquetWriter
 from smart_open import open as sopen
 
 
@@ -21,6 +20,23 @@ from smart_open import open as sopen
 ENCODING = 'utf-8'
 
 
+# Size in bytes of the block read from the start of the CSV file in
+# which to look for the header.
+HEAD_SIZE = 64 << 10
+
+
+# Size in bytes of the blocks in which PyArrow reads and parses the CSV
+# data.
+BLOCK_SIZE = 16 << 20
+
+
+# Target number of rows per Parquet row group and target size in bytes
+# of each Parquet data page. With this schema, a row group of 2^19 rows
+# is roughly 100 MiB of decoded Arrow data.
+ROW_GROUP_SIZE = 1 << 19
+DATA_PAGE_SIZE = 1 << 20
+
+
 # It's expected that the first line of the CSV file will be a header
 # with the following column names in the same order.
 HEADER = [
@@ -151,12 +167,6 @@ SCHEMA = pa.schema([
 ])
 
 
-# Data records may have additional fields not specified in the header.
-# These extra fields appear at the end of a record, so define a regex
-# that may extract only the desired leftmost fields.
-PATTERN_DATA = re.compile(rb'\A((?:[^,]*,){%d}[^,\r\n]*)' % (len(HEADER) - 1))
-
-
 class InvalidHeaderError(Exception):
     pass
 
@@ -165,67 +175,122 @@ class InvalidDataError(Exception):
     pass
 
 
-def read_green_taxi_csv(url, fobj):
+class PrefixedStream(RawIOBase):
+    """
+    A readable binary stream of the given prefix bytes followed by the
+    remainder of the underlying binary file object.
+    """
+
+    def __init__(self, prefix, fobj):
+        self._prefix = memoryview(prefix)
+        self._fobj = fobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self._prefix:
+            return self._fobj.readinto(buf)
+        num_bytes = min(len(buf), len(self._prefix))
+        buf[:num_bytes] = self._prefix[:num_bytes]
+        self._prefix = self._prefix[num_bytes:]
+        return num_bytes
+
+
+def read_green_taxi_csv_header(fobj):
     """
-    Read a "green taxi" CSV file from the New York City Taxi and
-    Limousine Commission (TLC) trip dataset, clean the data and write
-    the data into the provided binary file object.
+    Read the header of a "green taxi" CSV file from the New York City
+    Taxi and Limousine Commission (TLC) trip dataset from the provided
+    binary file object, and return the number of fields per data record
+    along with a binary stream of the data records.
+
+    The number of fields is taken from the first data record, which must
+    have at least as many fields as the header. Every later record must
+    have exactly as many fields as the first, otherwise the CSV parser
+    will raise an error.
 
     Note: tested against only one specific file:
 
       https://nyc-tlc.s3.us-east-1.amazonaws.com/trip%20data/green_tripdata_2013-09.csv
     """
 
-    # smart-open makes it easy to open a file via HTTP(S), S3, GCS,
-    # local etc URLs.
-    with sopen(url, mode='rb') as fobj_src:
-        # The first line should be the header. Validate that it's what
-        # we expect.
-        line = fobj_src.readline()
-        if line.rstrip().decode(ENCODING).split(',') != HEADER:
-            raise InvalidHeaderError(line)
-        # Ignore any whitespace-only lines between the header and data.
-        # Return if we encounter the end of the file.
-        while True:
-            offset = fobj_src.tell()
-            line = fobj_src.readline()
-            if line.rstrip():
-                fobj_src.seek(offset)
-                break
-            if not line:
-                return
-        # Ensure that there are at least 20 fields and preserve only
-        # these fields via regexp. The data has an odd structure in that
-        # there are additional trailing empty fields, which we ignore.
-        for line in fobj_src:
-            match = PATTERN_DATA.match(line)
-            if not match:
-                raise InvalidDataError(line)
-            fobj.write(match.group(1))
-            fobj.write(b'\n')
-
-
-def parse_green_taxi_csv(fobj):
+    # Read the start of the file as a single block rather than line by
+    # line, and only ever read forward. Seeking backwards may cost an
+    # additional request for remote files.
+    head = fobj.read(HEAD_SIZE)
+    # The first line should be the header. Validate that it's what we
+    # expect.
+    end = head.find(b'\n')
+    if end < 0:
+        raise InvalidHeaderError(head)
+    line = head[:end]
+    if line.rstrip().decode(ENCODING).split(',') != HEADER:
+        raise InvalidHeaderError(line)
+    # Ignore any whitespace-only lines between the header and data,
+    # reading further blocks if the first data record is incomplete.
+    start = end + 1
+    while True:
+        end = head.find(b'\n', start)
+        if end < 0:
+            block = fobj.read(HEAD_SIZE)
+            if block:
+                head = head[start:] + block
+                start = 0
+                continue
+            end = len(head)
+        line = head[start:end]
+        if line.strip():
+            break
+        if end == len(head):
+            return len(HEADER), PrefixedStream(b'', fobj)
+        start = end + 1
+    # Data records may have additional fields not specified in the
+    # header. The data has an odd structure in that there are additional
+    # trailing empty fields, which we ignore. Ensure that the first data
+    # record has at least 20 fields and count them so that the extra
+    # fields may be named and then dropped by the CSV parser. The CSV
+    # parser requires every record to have this same number of fields,
+    # so a later record with more or fewer fields raises an ArrowInvalid
+    # error rather than InvalidDataError.
+    num_fields = line.count(b',') + 1
+    if num_fields < len(HEADER):
+        raise InvalidDataError(line)
+    return num_fields, PrefixedStream(head[start:], fobj)
+
+
+def open_green_taxi_csv(fobj, num_fields):
     """
-    Parse a binary file object of cleaned "green taxi" CSV data as
-    returned by the "read_green_taxi_csv" function, and return a PyArrow
-    table.
+    Open a binary file object of "green taxi" CSV data records, as
+    returned by the "read_green_taxi_csv_header" function, and return
+    a PyArrow streaming reader yielding record batches.
+
+    PyArrow reads the file object incrementally in large blocks, so
+    only a few blocks are resident in memory at any time. Any trailing
+    fields beyond those in the schema are named "_extra<N>" and dropped
+    during conversion, so the data is never cleaned record-by-record in
+    Python. Every record must have exactly "num_fields" fields.
     """
 
+    column_names = SCHEMA.names + [
+        f'_extra{i}' for i in range(num_fields - len(SCHEMA))
+    ]
     convert_options = ConvertOptions(
         column_types=SCHEMA,
         false_values=['N'],
+        include_columns=SCHEMA.names,
         null_values=[''],
         timestamp_parsers=['%Y-%m-%d %H:%M:%S'],
         true_values=['Y'],
     )
     parse_options = ParseOptions(quote_char=False)
     read_options = ReadOptions(
-        column_names=SCHEMA.names,
+        block_size=BLOCK_SIZE,
+        column_names=column_names,
         encoding=ENCODING,
+        use_threads=True,
     )
 
-    return read_csv(
+    return open_csv(
         fobj,
         convert_options=convert_options,
         parse_options=parse_options,
@@ -233,11 +298,43 @@ def parse_green_taxi_csv(fobj):
     )
 
 
-def write_table_to_parquet(table, path):
+def write_batches_to_parquet(batches, path):
     """
-    Write a PyArrow table to a Parquet file.
+    Write an iterable of PyArrow record batches to a Parquet file.
+
+    Batches are buffered until they amount to a full row group, so that
+    the row group size doesn't depend on the CSV block size.
     """
-    write_table(table, path, version='2.0')
+    with ParquetWriter(
+        path,
+        SCHEMA,
+        compression='zstd',
+        compression_level=3,
+        data_page_size=DATA_PAGE_SIZE,
+        data_page_version='2.0',
+        use_dictionary=True,
+        version='2.0',
+        write_statistics=True,
+    ) as writer:
+        buffered = []
+        num_rows = 0
+        for batch in batches:
+            buffered.append(batch)
+            num_rows += batch.num_rows
+            # Write exactly one full row group at a time and carry any
+            # remaining rows over into the next row group.
+            while num_rows >= ROW_GROUP_SIZE:
+                table = pa.Table.from_batches(buffered, schema=SCHEMA)
+                writer.write_table(
+                    table.slice(0, ROW_GROUP_SIZE),
+                    row_group_size=ROW_GROUP_SIZE,
+                )
+                remainder = table.slice(ROW_GROUP_SIZE)
+                buffered = remainder.to_batches()
+                num_rows = remainder.num_rows
+        if num_rows:
+            table = pa.Table.from_batches(buffered, schema=SCHEMA)
+            writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
 
 
 def main():
@@ -250,15 +347,16 @@ def main():
     )
     path = Path('01.parquet')
 
-    # Read/clean the source data into a binary buffer, then parse that
-    # buffer into a PyArrow table.
-    with BytesIO() as buf:
-        read_green_taxi_csv(url, buf)
-        buf.seek(0)
-        table = parse_green_taxi_csv(buf)
-
-    # Write the PyArrow table to a Parquet file.
-    write_table_to_parquet(table, path)
+    # Validate the header, then stream the source data records through
+    # the CSV parser and into a Parquet file batch by batch, so that
+    # row groups are written while later blocks are still being parsed.
+    # smart-open makes it easy to open a file via HTTP(S), S3, GCS,
+    # local etc URLs. The source data is uncompressed, so disable
+    # smart-open's extension-based transparent decompression.
+    with sopen(url, mode='rb', ignore_ext=True) as fobj:
+        num_fields, records = read_green_taxi_csv_header(fobj)
+        reader = open_green_taxi_csv(records, num_fields)
+        write_batches_to_parquet(reader, path)
 
 
 if __name__ == '__main__':
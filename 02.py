@@ -4,9 +4,9 @@ write the result to another Parquet file.
 """
 
 # stdlib imports
-import shutil
+import os
 import textwrap
-from io import StringIO
+from functools import lru_cache
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -14,20 +14,40 @@ from tempfile import TemporaryDirectory
 from pyspark.sql import SparkSession
 
 
-def build_query(table_alias):
+@lru_cache()
+def build_query(table_alias, column_names):
     """
     Build a Spark SQL query satisfying the requirements of the exercise.
+
+    The query selects the given columns of the table plus the derived
+    columns. Column names must be given as a tuple so that the query may
+    be cached.
     """
 
+    # The pickup hour and day of week are each projected once in a CTE,
+    # so that every one-hot indicator compares against an
+    # already-computed integer instead of recomputing HOUR/DAYOFWEEK.
+    # These helper columns are not part of the output, so the input
+    # columns are listed explicitly rather than selected via "*".
     template = textwrap.dedent("""\
+        WITH src AS (
         SELECT
         *,
+        HOUR(lpep_pickup_datetime) AS _pickup_hour,
+        DAYOFWEEK(lpep_pickup_datetime) AS _pickup_dow
+        FROM
+        {table_alias}
+        )
+        SELECT
+        {columns},
         {one_hot_hour},
         {one_hot_dow},
         {duration},
         {jfk}
         FROM
-        {table_alias}""")
+        src""")
+
+    columns = ',\n'.join(f'`{name}`' for name in column_names)
 
     # Generate SQL to select a one-hot encoding of the pickup hour of
     # the day. The instructions don't specify which timestamp(s) we care
@@ -35,15 +55,16 @@ def build_query(table_alias):
     # Spark environment runs in a UTC timezone and the timestamps are in
     # "local" (UTC) time; for simplicity we'll keep that as-is and not
     # convert to local time.
-    one_hot_hour = StringIO()
-    num_hours = 24
-    for hour in range(num_hours):
-        one_hot_hour.write(
-            f'CASE WHEN HOUR(lpep_pickup_datetime) = {hour} THEN 1 '
-            f'ELSE 0 END AS Pickup_hour_is_{hour}'
-        )
-        if hour < num_hours - 1:
-            one_hot_hour.write(',\n')
+    #
+    # Casting the comparison to an integer rather than using CASE WHEN
+    # lets Spark's generated code evaluate each indicator without a
+    # branch. As with CASE WHEN, COALESCE maps a null pickup timestamp to
+    # 0 rather than null, so the indicators remain non-nullable.
+    one_hot_hour = ',\n'.join(
+        f'CAST(COALESCE(_pickup_hour = {hour}, FALSE) AS TINYINT) '
+        f'AS Pickup_hour_is_{hour}'
+        for hour in range(24)
+    )
 
     # Generate SQL to select a one-hot encoding of the pickup day of
     # week. The instructions don't specify which timestamp(s) we care
@@ -54,25 +75,21 @@ def build_query(table_alias):
     #
     # Here, day 0 corresponds to Sunday and day 6 corresponds to
     # Saturday.
-    one_hot_dow = StringIO()
-    num_days = 7
-    for dow in range(num_days):
-        one_hot_dow.write(
-            f'CASE WHEN DAYOFWEEK(lpep_pickup_datetime) = {dow} THEN 1 '
-            f'ELSE 0 END AS Pickup_dow_is_{dow}'
-        )
-        if dow < num_days - 1:
-            one_hot_dow.write(',\n')
+    one_hot_dow = ',\n'.join(
+        f'CAST(COALESCE(_pickup_dow = {dow}, FALSE) AS TINYINT) '
+        f'AS Pickup_dow_is_{dow}'
+        for dow in range(7)
+    )
 
     # SQL to select the ride duration in seconds. Duration in seconds
-    # may be computed by casting to the number of seconds elapsed since
+    # may be computed by extracting the number of seconds elapsed since
     # the POSIX epoch and subtracting.
     #
     # Interestingly, some negative durations are computed, which
     # suggests an issue with the source data.
     duration = (
-        'CAST(lpep_dropoff_datetime AS LONG) - '
-        'CAST(lpep_pickup_datetime AS LONG) AS Duration_seconds'
+        'UNIX_TIMESTAMP(lpep_dropoff_datetime) - '
+        'UNIX_TIMESTAMP(lpep_pickup_datetime) AS Duration_seconds'
     )
 
     # SQL to determine whether a pickup or dropoff occurred at JFK
@@ -86,17 +103,22 @@ def build_query(table_alias):
     lon_max = -73.776283
     lat_min = 40.640668
     lat_max = 40.651381
+    #
+    # As with the one-hot indicators, the condition is cast to an
+    # integer rather than mapped via CASE WHEN, and COALESCE maps a null
+    # condition (e.g. null coordinates) to 0.
     jfk = (
-        f'CASE WHEN (Pickup_longitude BETWEEN {lon_min} AND {lon_max} '
+        f'CAST(COALESCE((Pickup_longitude BETWEEN {lon_min} AND {lon_max} '
         f'AND Pickup_latitude BETWEEN {lat_min} AND {lat_max}) OR '
         f'(Dropoff_longitude BETWEEN {lon_min} AND {lon_max} AND '
-        f'Dropoff_latitude BETWEEN {lat_min} AND {lat_max}) THEN 1 '
-        f'ELSE 0 END AS Pickup_or_dropoff_at_JFK'
+        f'Dropoff_latitude BETWEEN {lat_min} AND {lat_max}), FALSE) '
+        f'AS TINYINT) AS Pickup_or_dropoff_at_JFK'
     )
 
     return template.format(
-        one_hot_hour=one_hot_hour.getvalue(),
-        one_hot_dow=one_hot_dow.getvalue(),
+        columns=columns,
+        one_hot_hour=one_hot_hour,
+        one_hot_dow=one_hot_dow,
         duration=duration,
         jfk=jfk,
         table_alias=table_alias,
@@ -113,19 +135,32 @@ def main():
     # To more easily provide a single Parquet file for inspection (and
     # not within the directory automatically created by Hadoop/Spark),
     # we have Spark write its results to a temporary directory and then
-    # later move the single Parquet file outside of that directory.
-    with TemporaryDirectory() as output_dir:
+    # later move the single Parquet file outside of that directory. The
+    # temporary directory is created alongside the output file so that
+    # the move is a rename within one filesystem rather than a copy.
+    with TemporaryDirectory(dir=output_file.parent) as output_dir:
         output_dir = Path(output_dir)
         output_url = f'file://{output_dir}'
 
-        with SparkSession.builder.getOrCreate() as spark:
+        # Read Parquet in larger vectorized batches than the default and
+        # compress the output with Zstandard, as in part 1.
+        builder = (
+            SparkSession.builder
+            .config('spark.sql.parquet.enableVectorizedReader', 'true')
+            .config('spark.sql.parquet.columnarReaderBatchSize', '8192')
+            .config('spark.sql.parquet.compression.codec', 'zstd')
+        )
+
+        with builder.getOrCreate() as spark:
             # Read the file from the part 1.
             input_df = spark.read.parquet(input_url)
 
             # Build the SQL query and execute it.
             input_sql_alias = 'input_df'
             input_df.createOrReplaceTempView(input_sql_alias)
-            output_df = spark.sql(build_query(input_sql_alias))
+            output_df = spark.sql(
+                build_query(input_sql_alias, tuple(input_df.columns)),
+            )
 
             # Write the result in Parquet format.
             output_df.coalesce(1).write.parquet(
@@ -135,7 +170,7 @@ def main():
 
         # Move the Parquet file so that it's accessible outside of the
         # container.
-        shutil.move(next(output_dir.glob('*.parquet')), output_file)
+        os.replace(next(output_dir.glob('*.parquet')), output_file)
 
 
 if __name__ == '__main__':